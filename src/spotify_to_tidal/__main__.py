@@ -15,11 +15,13 @@ def main():
     with open(args.config, 'r') as f:
         config = yaml.safe_load(f)
     print("Opening Spotify session")
-    spotify_session = _auth.open_spotify_session(config['spotify'])
+    spotify_session = _auth.open_spotify_session(config['spotify'], config.get('max_concurrency', 10))
     print("Opening Tidal session")
     tidal_session = _auth.open_tidal_session()
     if not tidal_session.check_login():
         sys.exit("Could not connect to Tidal")
+    # allow the concurrent Tidal searches to each keep their connection alive instead of reconnecting
+    _auth.size_connection_pool(tidal_session.request_session, config.get('max_concurrency', 10))
     if args.uri:
         # if a playlist ID is explicitly provided as a command line argument then use that
         spotify_playlist = spotify_session.playlist(args.uri)
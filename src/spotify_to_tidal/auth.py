@@ -1,19 +1,22 @@
 #!/usr/bin/env python3
 
+import requests
 import sys
 import spotipy
 import tidalapi
+import urllib3
 import webbrowser
 import yaml
 
 __all__ = [
     'open_spotify_session',
-    'open_tidal_session'
+    'open_tidal_session',
+    'size_connection_pool'
 ]
 
 SPOTIFY_SCOPES = 'playlist-read-private, user-library-read'
 
-def open_spotify_session(config) -> spotipy.Spotify:
+def open_spotify_session(config, pool_size: int = 10) -> spotipy.Spotify:
     credentials_manager = spotipy.SpotifyOAuth(username=config['username'],
 				       scope=SPOTIFY_SCOPES,
 				       client_id=config['client_id'],
@@ -25,7 +28,10 @@ def open_spotify_session(config) -> spotipy.Spotify:
     except spotipy.SpotifyOauthError:
         sys.exit("Error opening Spotify sesion; could not get token for username: ".format(config['username']))
 
-    return spotipy.Spotify(oauth_manager=credentials_manager)
+    # the pages of a playlist are fetched concurrently, so keep enough connections alive for all of them
+    requests_session = requests.Session()
+    size_connection_pool(requests_session, pool_size)
+    return spotipy.Spotify(oauth_manager=credentials_manager, requests_session=requests_session)
 
 def open_tidal_session(config = None) -> tidalapi.Session:
     try:
@@ -61,4 +67,16 @@ def open_tidal_session(config = None) -> tidalapi.Session:
                    'refresh_token': session.refresh_token}, f )
     return session
 
-
+def size_connection_pool(session: requests.Session, pool_size: int):
+    '''
+    Mount an adapter whose pool keeps up to pool_size connections per host, so concurrent requests reuse keep-alive connections
+    Reads which hit a transient server error are retried a few times with a short backoff, and once the retries run out the
+    last response is returned rather than raising, so that the api client reports the error as usual
+    Rate limited responses are not retried here but handed straight to the api client, so that the sync's own retries are the
+    only ones waiting for as long as the server asks in its Retry-After header
+    '''
+    retry = urllib3.Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET']),
+                          respect_retry_after_header=False, raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
@@ -1,17 +1,34 @@
 import datetime
 import sqlalchemy
-from sqlalchemy import Table, Column, String, DateTime, MetaData, insert, select, update, delete
-from typing import Dict, List, Sequence, Set, Mapping
+from sqlalchemy import Table, Column, String, Integer, DateTime, MetaData, select, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from typing import Dict, Iterable, Set
+
+
+def _create_engine(filename: str) -> sqlalchemy.Engine:
+    """ sqlite engine using write-ahead logging, so that readers aren't blocked by a writer and commits need fewer syncs to disk """
+    engine = sqlalchemy.create_engine(f"sqlite:///{filename}")
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return engine
 
 
 class MatchFailureDatabase:
     """ 
     sqlite database of match failures which persists between runs
     this can be used concurrently between multiple processes
+    the ids of known failures are also kept in memory so that lookups for other tracks don't need to query the database,
+    failures recorded by other processes after loading are missed by this filter and are simply searched for again
     """
 
     def __init__(self, filename='.cache.db'):
-        self.engine = sqlalchemy.create_engine(f"sqlite:///{filename}")
+        self.engine = _create_engine(filename)
         meta = MetaData()
         self.match_failures = Table('match_failures', meta,
                                     Column('track_id', String,
@@ -20,6 +37,8 @@ class MatchFailureDatabase:
                                     Column('next_retry', DateTime),
                                     sqlite_autoincrement=False)
         meta.create_all(self.engine)
+        with self.engine.connect() as connection:
+            self.failure_ids: Set[str] = set(connection.execute(select(self.match_failures.c.track_id)).scalars())
 
     def _get_next_retry_time(self, insert_time: datetime.datetime | None = None) -> datetime.datetime:
         if insert_time:
@@ -31,23 +50,27 @@ class MatchFailureDatabase:
 
     def cache_match_failure(self, track_id: str):
         """ notifies that matching failed for the given track_id """
-        fetch_statement = select(self.match_failures).where(
-            self.match_failures.c.track_id == track_id)
+        self.cache_match_failures([track_id])
+
+    def cache_match_failures(self, track_ids: Iterable[str]):
+        """ notifies that matching failed for all the given track_ids, writing them in a single transaction """
+        now = datetime.datetime.now()
+        next_retry = self._get_next_retry_time()
+        failures = [{"track_id": track_id, "insert_time": now, "next_retry": next_retry} for track_id in track_ids]
+        if not failures:
+            return
+        # Either update the next_retry time if track_id already exists, otherwise create a new entry
+        statement = sqlite_insert(self.match_failures).on_conflict_do_update(
+            index_elements=[self.match_failures.c.track_id], set_={"next_retry": next_retry})
         with self.engine.connect() as connection:
             with connection.begin():
-                # Either update the next_retry time if track_id already exists, otherwise create a new entry
-                existing_failure = connection.execute(
-                    fetch_statement).fetchone()
-                if existing_failure:
-                    update_statement = update(self.match_failures).where(
-                        self.match_failures.c.track_id == track_id).values(next_retry=self._get_next_retry_time())
-                    connection.execute(update_statement)
-                else:
-                    connection.execute(insert(self.match_failures), {
-                                       "track_id": track_id, "insert_time": datetime.datetime.now(), "next_retry": self._get_next_retry_time()})
+                connection.execute(statement, failures)
+        self.failure_ids.update(failure["track_id"] for failure in failures)
 
     def has_match_failure(self, track_id: str) -> bool:
         """ checks if there was a recent search for which matching failed with the given track_id """
+        if not track_id in self.failure_ids:
+            return False
         statement = select(self.match_failures.c.next_retry).where(
             self.match_failures.c.track_id == track_id)
         with self.engine.connect() as connection:
@@ -56,29 +79,135 @@ class MatchFailureDatabase:
                 return match_failure.next_retry > datetime.datetime.now()
             return False
 
+    def has_match_failures(self, track_ids: Iterable[str], chunk_size: int = 500) -> Set[str]:
+        """ returns the subset of track_ids for which there was a recent search where matching failed """
+        track_ids = [track_id for track_id in track_ids if track_id in self.failure_ids]
+        output = set()
+        if not track_ids:
+            return output
+        now = datetime.datetime.now()
+        with self.engine.connect() as connection:
+            # query in chunks to stay below sqlite's limit on the number of bound parameters
+            for offset in range(0, len(track_ids), chunk_size):
+                statement = select(self.match_failures.c.track_id).where(
+                    self.match_failures.c.track_id.in_(track_ids[offset:offset+chunk_size]),
+                    self.match_failures.c.next_retry > now)
+                output.update(row.track_id for row in connection.execute(statement))
+        return output
+
     def remove_match_failure(self, track_id: str):
         """ removes match failure from the database """
-        statement = delete(self.match_failures).where(
-            self.match_failures.c.track_id == track_id)
+        self.remove_match_failures([track_id])
+
+    def remove_match_failures(self, track_ids: Iterable[str], chunk_size: int = 500):
+        """ removes the match failures for all the given track_ids in a single transaction """
+        track_ids = list(track_ids)
         with self.engine.connect() as connection:
             with connection.begin():
-                connection.execute(statement)
+                # delete in chunks to stay below sqlite's limit on the number of bound parameters
+                for offset in range(0, len(track_ids), chunk_size):
+                    statement = delete(self.match_failures).where(
+                        self.match_failures.c.track_id.in_(track_ids[offset:offset+chunk_size]))
+                    connection.execute(statement)
+        self.failure_ids.difference_update(track_ids)
 
 
 class TrackMatchCache:
     """
-    Non-persistent mapping of spotify ids -> tidal_ids
+    mapping of spotify ids -> tidal_ids, along with a mapping of isrcs -> tidal_ids for tracks that were found by searching
+    if a filename is given then persisted matches are loaded from that sqlite database, so that tracks found by searching
+    in a previous run don't need to be searched for again, even when they appear with a different spotify id
+    persisted matches older than max_age are forgotten, so that those tracks are searched for again and pick up any changes on Tidal
     This should NOT be accessed concurrently from multiple processes
     """
-    data: Dict[str, int] = {}
+    __slots__ = ('data', 'isrc_data', 'engine', 'track_matches', 'isrc_matches')
+
+    def __init__(self, filename: str | None = None, max_age: datetime.timedelta = datetime.timedelta(days=30)):
+        # per instance, so that separate caches (e.g. in tests) don't share their mappings
+        self.data: Dict[str, int] = {}
+        self.isrc_data: Dict[str, int] = {}
+        self.engine = None
+        if filename:
+            self.engine = _create_engine(filename)
+            meta = MetaData()
+            self.track_matches = Table('track_matches', meta,
+                                       Column('track_id', String,
+                                              primary_key=True),
+                                       Column('tidal_id', Integer),
+                                       Column('insert_time', DateTime),
+                                       sqlite_autoincrement=False)
+            self.isrc_matches = Table('isrc_matches', meta,
+                                      Column('isrc', String,
+                                             primary_key=True),
+                                      Column('tidal_id', Integer),
+                                      Column('insert_time', DateTime),
+                                      sqlite_autoincrement=False)
+            meta.create_all(self.engine)
+            expiry = datetime.datetime.now() - max_age
+            with self.engine.connect() as connection:
+                with connection.begin():
+                    for table in (self.track_matches, self.isrc_matches):
+                        connection.execute(delete(table).where(table.c.insert_time < expiry))
+                statement = select(self.track_matches.c.track_id, self.track_matches.c.tidal_id)
+                self.data.update({row.track_id: row.tidal_id for row in connection.execute(statement)})
+                statement = select(self.isrc_matches.c.isrc, self.isrc_matches.c.tidal_id)
+                self.isrc_data.update({row.isrc: row.tidal_id for row in connection.execute(statement)})
 
     def get(self, track_id: str) -> int | None:
         return self.data.get(track_id, None)
 
+    def has_matches(self, track_ids: Iterable[str]) -> Set[str]:
+        """ returns the subset of track_ids which have a cached match """
+        return self.data.keys() & track_ids
+
+    def get_by_isrc(self, isrc: str) -> int | None:
+        return self.isrc_data.get(isrc, None)
+
     def insert(self, mapping: tuple[str, int]):
         self.data[mapping[0]] = mapping[1]
 
+    def insert_isrc(self, mapping: tuple[str, int]):
+        self.isrc_data[mapping[0]] = mapping[1]
+
+    def persist(self, track_ids: Iterable[str], isrcs: Iterable[str] = ()):
+        """ writes the cached matches of the given track_ids and isrcs to the database in a single transaction """
+        if not self.engine:
+            return
+        now = datetime.datetime.now()
+        matches = [{"track_id": track_id, "tidal_id": self.data[track_id], "insert_time": now} for track_id in track_ids if track_id in self.data]
+        isrc_matches = [{"isrc": isrc, "tidal_id": self.isrc_data[isrc], "insert_time": now} for isrc in isrcs if isrc in self.isrc_data]
+        if not matches and not isrc_matches:
+            return
+        # Either update the tidal_id and insert_time if the key already exists, otherwise create a new entry
+        with self.engine.connect() as connection:
+            with connection.begin():
+                for table, key, rows in ((self.track_matches, self.track_matches.c.track_id, matches),
+                                         (self.isrc_matches, self.isrc_matches.c.isrc, isrc_matches)):
+                    if rows:
+                        insert = sqlite_insert(table)
+                        statement = insert.on_conflict_do_update(
+                            index_elements=[key], set_={"tidal_id": insert.excluded.tidal_id, "insert_time": insert.excluded.insert_time})
+                        connection.execute(statement, rows)
+
+    def remove_tidal_ids(self, tidal_ids: Iterable[int], chunk_size: int = 500):
+        """ forgets every match to the given tidal_ids, e.g. because those tracks are no longer available on Tidal """
+        tidal_ids = set(tidal_ids)
+        if not tidal_ids:
+            return
+        for mapping in (self.data, self.isrc_data):
+            for key in [key for key, tidal_id in mapping.items() if tidal_id in tidal_ids]:
+                del mapping[key]
+        if not self.engine:
+            return
+        tidal_ids = list(tidal_ids)
+        with self.engine.connect() as connection:
+            with connection.begin():
+                # delete in chunks to stay below sqlite's limit on the number of bound parameters
+                for table in (self.track_matches, self.isrc_matches):
+                    for offset in range(0, len(tidal_ids), chunk_size):
+                        connection.execute(delete(table).where(table.c.tidal_id.in_(tidal_ids[offset:offset+chunk_size])))
+
 
 # Main singleton instance
 failure_cache = MatchFailureDatabase()
-track_match_cache = TrackMatchCache()
+track_match_cache = TrackMatchCache('.cache.db')
@@ -1,303 +1,573 @@
 #!/usr/bin/env python3
 
 import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from .cache import failure_cache, track_match_cache
-import datetime
-from difflib import SequenceMatcher
-from functools import partial
-from typing import Callable, List, Sequence, Set, Mapping
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
+from typing import AsyncIterator, Callable, FrozenSet, Iterable, List, Sequence, Set, Mapping, Tuple
 import math
+import random
+from rapidfuzz import fuzz, process, utils
+import re
 import requests
 import sys
 import spotipy
 import tidalapi
-from .tidalapi_patch import add_multiple_tracks_to_playlist, clear_tidal_playlist, get_all_favorites, get_all_playlists, get_all_playlist_tracks, get_all_playlist_tracks
+from .tidalapi_patch import add_multiple_tracks_to_playlist, clear_tidal_playlist, get_all_favorites, get_all_playlists, get_all_playlist_tracks
 import time
-from tqdm.asyncio import tqdm as atqdm
 from tqdm import tqdm
 import traceback
 import unicodedata
-import math
 
 from .type import spotify as t_spotify
 
-def normalize(s) -> str:
-    return unicodedata.normalize('NFD', s).encode('ascii', 'ignore').decode('ascii')
+# translation table which drops the combining marks left behind by NFD decomposition (i.e. accents)
+_DROP_COMBINING = dict.fromkeys(c for c in range(sys.maxunicode + 1) if unicodedata.combining(chr(c)))
 
+# translation table giving the ascii result of the full normalization below for each accented latin letter (i.e. 'é' -> 'e')
+# and each general punctuation mark such as curly quotes or dashes, which the full normalization drops
+_LATIN_TO_ASCII = {c: unicodedata.normalize('NFD', chr(c)).translate(_DROP_COMBINING).encode('ascii', 'ignore').decode('ascii')
+                   for c in chain(range(0x80, 0x250), range(0x2000, 0x2070))}
+
+def normalize(s) -> str:
+    if s.isascii():
+        return s # NFD decomposition cannot change a pure ascii string
+    return _normalize_non_ascii(s)
+
+@lru_cache(maxsize=65536)
+def _normalize_non_ascii(s: str) -> str:
+    """ only non-ascii strings are cached, so they aren't evicted by the far more common ascii names """
+    # most names only contain accented latin letters and punctuation, which can be mapped without decomposing the whole string
+    t = s.translate(_LATIN_TO_ASCII)
+    if t.isascii():
+        return t
+    s = unicodedata.normalize('NFD', s).translate(_DROP_COMBINING)
+    if s.isascii():
+        return s
+    # fall back to dropping any remaining characters which have no ascii decomposition
+    return s.encode('ascii', 'ignore').decode('ascii')
+
+_VERSION_SEPARATORS = re.compile(r'[-(\[]')
+
+@lru_cache(maxsize=65536)
 def simple(input_string: str) -> str:
     # only take the first part of a string before any hyphens or brackets to account for different versions
-    return input_string.split('-')[0].strip().split('(')[0].strip().split('[')[0].strip()
-
-def isrc_match(tidal_track: tidalapi.Track, spotify_track) -> bool:
-    if "isrc" in spotify_track["external_ids"]:
-        return tidal_track.isrc == spotify_track["external_ids"]["isrc"]
-    return False
-
-def duration_match(tidal_track: tidalapi.Track, spotify_track, tolerance=2) -> bool:
+    separator = _VERSION_SEPARATORS.search(input_string)
+    return (input_string[:separator.start()] if separator else input_string).strip()
+
+# versions of a track which must only ever match the same kind of version
+_EXCLUSION_PATTERNS = ("instrumental", "acapella", "remix")
+
+def _exclusions(*texts: str) -> FrozenSet[str]:
+    return frozenset(pattern for pattern in _EXCLUSION_PATTERNS if any(pattern in text for text in texts))
+
+@dataclass(frozen=True, slots=True)
+class SpotifyMatchKey:
+    """ The fields of a Spotify track used for matching, extracted once per track rather than once per candidate pair """
+    id: str
+    isrc: str | None
+    name: str # lowercase
+    simple_name: str # simplified lowercase name without any featured artists
+    normalized_simple_name: str
+    exclusions: FrozenSet[str] # the exclusion patterns found in the name
+    artists: Tuple[str, ...]
+    duration: float # seconds
+
+    @classmethod
+    def from_track(cls, spotify_track: t_spotify.SpotifyTrack) -> 'SpotifyMatchKey':
+        name = spotify_track['name'].lower()
+        simple_name = simple(name).split('feat.')[0].strip()
+        return cls(id=spotify_track['id'],
+                   isrc=spotify_track['external_ids'].get('isrc'),
+                   name=name,
+                   simple_name=simple_name,
+                   normalized_simple_name=normalize(simple_name),
+                   exclusions=_exclusions(name),
+                   artists=tuple(sys.intern(artist['name']) for artist in spotify_track['artists']),
+                   duration=spotify_track['duration_ms']/1000)
+
+@dataclass(frozen=True, slots=True)
+class TidalMatchKey:
+    """ The fields of a Tidal track used for matching, extracted once per track rather than once per candidate pair """
+    id: int
+    isrc: str | None
+    name: str # lowercase
+    exclusions: FrozenSet[str] # the exclusion patterns found in the name or version
+    artists: Tuple[str, ...]
+    duration: float # seconds
+
+    @classmethod
+    def from_track(cls, tidal_track: tidalapi.Track) -> 'TidalMatchKey':
+        name = tidal_track.name.lower()
+        version = tidal_track.version.lower() if tidal_track.version else ''
+        return cls(id=tidal_track.id,
+                   isrc=tidal_track.isrc,
+                   name=name,
+                   exclusions=_exclusions(name, version),
+                   artists=tuple(sys.intern(artist.name) for artist in tidal_track.artists),
+                   duration=tidal_track.duration)
+
+def isrc_match(tidal: TidalMatchKey, spotify: SpotifyMatchKey) -> bool:
+    return spotify.isrc is not None and tidal.isrc == spotify.isrc
+
+def duration_match(tidal: TidalMatchKey, spotify: SpotifyMatchKey, tolerance=2) -> bool:
     # the duration of the two tracks must be the same to within 2 seconds
-    return abs(tidal_track.duration - spotify_track['duration_ms']/1000) < tolerance
+    return abs(tidal.duration - spotify.duration) < tolerance
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
 
-def name_match(tidal_track, spotify_track) -> bool:
-    def exclusion_rule(pattern: str, tidal_track: tidalapi.Track, spotify_track: t_spotify.SpotifyTrack):
-        spotify_has_pattern = pattern in spotify_track['name'].lower()
-        tidal_has_pattern = pattern in tidal_track.name.lower() or (not tidal_track.version is None and (pattern in tidal_track.version.lower()))
-        return spotify_has_pattern != tidal_has_pattern
+@lru_cache(maxsize=65536)
+def _strip_punctuation(name: str) -> str:
+    return ' '.join(_PUNCTUATION.sub('', name).split())
 
+def name_match(tidal: TidalMatchKey, spotify: SpotifyMatchKey) -> bool:
     # handle some edge cases
-    if exclusion_rule("instrumental", tidal_track, spotify_track): return False
-    if exclusion_rule("acapella", tidal_track, spotify_track): return False
-    if exclusion_rule("remix", tidal_track, spotify_track): return False
+    if spotify.exclusions != tidal.exclusions: return False
 
     # the simplified version of the Spotify track name must be a substring of the Tidal track name
     # Try with both un-normalized and then normalized
-    simple_spotify_track = simple(spotify_track['name'].lower()).split('feat.')[0].strip()
-    return simple_spotify_track in tidal_track.name.lower() or normalize(simple_spotify_track) in normalize(tidal_track.name.lower())
-
-def artist_match(tidal: tidalapi.Track | tidalapi.Album, spotify) -> bool:
-    def split_artist_name(artist: str) -> Sequence[str]:
-       if '&' in artist:
-           return artist.split('&')
-       elif ',' in artist:
-           return artist.split(',')
-       else:
-           return [artist]
-
-    def get_tidal_artists(tidal: tidalapi.Track | tidalapi.Album, do_normalize=False) -> Set[str]:
-        result: list[str] = []
-        for artist in tidal.artists:
-            if do_normalize:
-                artist_name = normalize(artist.name)
-            else:
-                artist_name = artist.name
-            result.extend(split_artist_name(artist_name))
-        return set([simple(x.strip().lower()) for x in result])
-
-    def get_spotify_artists(spotify, do_normalize=False) -> Set[str]:
-        result: list[str] = []
-        for artist in spotify['artists']:
-            if do_normalize:
-                artist_name = normalize(artist['name'])
-            else:
-                artist_name = artist['name']
-            result.extend(split_artist_name(artist_name))
-        return set([simple(x.strip().lower()) for x in result])
+    if spotify.simple_name in tidal.name:
+        return True
+    normalized_tidal_name = normalize(tidal.name)
+    if spotify.normalized_simple_name in normalized_tidal_name:
+        return True
+    # otherwise allow for differences in punctuation and the odd spelling difference between the simplified names,
+    # but not a differing word or number, which is more likely a different work, e.g. "Symphony No. 5" and "Symphony No. 6"
+    return fuzz.ratio(spotify.normalized_simple_name, simple(normalized_tidal_name), processor=_strip_punctuation, score_cutoff=95) > 0
+
+_ARTIST_SEPARATORS = re.compile(r'[&,]')
+
+def split_artist_name(artist: str) -> Sequence[str]:
+    return _ARTIST_SEPARATORS.split(artist)
+
+@lru_cache(maxsize=50_000)
+def _get_artist_set(artist_names: Tuple[str, ...], do_normalize: bool) -> FrozenSet[str]:
+    """ Simplified lowercase artist names, keyed by the raw names so the work is shared by every track and playlist with the same artists """
+    if do_normalize:
+        artist_names = tuple(normalize(artist_name) for artist_name in artist_names)
+    # interned so that intersecting the sets of two tracks by the same artist compares by identity
+    return frozenset(sys.intern(simple(x.strip().lower())) for artist_name in artist_names for x in split_artist_name(artist_name))
+
+@lru_cache(maxsize=50_000)
+def _get_fuzzy_artist_names(artist_names: Tuple[str, ...]) -> Tuple[str, ...]:
+    """ Whole artist names with accents, punctuation and case removed, for fuzzy comparison """
+    return tuple(utils.default_process(normalize(name)) for name in artist_names)
+
+def artist_match(tidal_artists: Tuple[str, ...], spotify_artists: Tuple[str, ...]) -> bool:
     # There must be at least one overlapping artist between the Tidal and Spotify track
     # Try with both un-normalized and then normalized
-    if get_tidal_artists(tidal).intersection(get_spotify_artists(spotify)) != set():
+    # isdisjoint stops at the first common artist rather than building the whole intersection
+    if not _get_artist_set(tidal_artists, False).isdisjoint(_get_artist_set(spotify_artists, False)):
+        return True
+    # normalizing leaves ascii names unchanged, so it can only find a new overlap if some name is non-ascii
+    all_ascii = all(name.isascii() for name in tidal_artists) and all(name.isascii() for name in spotify_artists)
+    if not all_ascii and not _get_artist_set(tidal_artists, True).isdisjoint(_get_artist_set(spotify_artists, True)):
         return True
-    return get_tidal_artists(tidal, True).intersection(get_spotify_artists(spotify, True)) != set()
-
-def match(tidal_track, spotify_track) -> bool:
-    if not spotify_track['id']: return False
-    return isrc_match(tidal_track, spotify_track) or (
-        duration_match(tidal_track, spotify_track)
-        and name_match(tidal_track, spotify_track)
-        and artist_match(tidal_track, spotify_track)
+    # finally allow for differences in punctuation or spelling, e.g. "Jay-Z" and "JAY Z"
+    tidal_names = _get_fuzzy_artist_names(tidal_artists)
+    return any(process.extractOne(name, tidal_names, scorer=fuzz.ratio, score_cutoff=90) for name in _get_fuzzy_artist_names(spotify_artists))
+
+def match(tidal: TidalMatchKey, spotify: SpotifyMatchKey) -> bool:
+    if not spotify.id: return False
+    # the predicates are ordered from cheapest to most expensive so that most mismatches exit early
+    return isrc_match(tidal, spotify) or (
+        duration_match(tidal, spotify)
+        and name_match(tidal, spotify)
+        and artist_match(tidal.artists, spotify.artists)
     )
 
 def test_album_similarity(spotify_album, tidal_album, threshold=0.6):
-    return SequenceMatcher(None, simple(spotify_album['name']), simple(tidal_album.name)).ratio() >= threshold and artist_match(tidal_album, spotify_album)
+    # rapidfuzz's indel ratio is SequenceMatcher's ratio computed on the longest common subsequence, in C++
+    return fuzz.ratio(simple(spotify_album['name']), simple(tidal_album.name), score_cutoff=threshold * 100) > 0 and artist_match(
+        tuple(artist.name for artist in tidal_album.artists), tuple(artist['name'] for artist in spotify_album['artists']))
+
+@dataclass(slots=True)
+class TidalSearchMemo:
+    """ Tidal lookups shared by the track searches of a single search_new_tracks_on_tidal call, which repeat them for tracks from the same album """
+    albums: dict[str, List[tidalapi.Album]] = field(default_factory=dict)
+    # keyed by Tidal album id and track index, as the album objects differ between searches
+    album_tracks: dict[Tuple[int, int], tidalapi.Track | None] = field(default_factory=dict)
+
+def _search_tidal_albums(tidal_session: tidalapi.Session, query: str, memo: TidalSearchMemo) -> List[tidalapi.Album]:
+    """ Album searches are memoized by query since every track searched from the same Spotify album issues the same one """
+    if query not in memo.albums:
+        memo.albums[query] = tidal_session.search(query, models=[tidalapi.album.Album])['albums']
+    return memo.albums[query]
+
+def _get_album_track(album: tidalapi.Album, index: int, memo: TidalSearchMemo) -> tidalapi.Track | None:
+    """ Fetch only the track at the given index of the album rather than the whole track listing """
+    key = (album.id, index)
+    if key not in memo.album_tracks:
+        tracks = album.tracks(limit=1, offset=index)
+        memo.album_tracks[key] = tracks[0] if tracks else None
+    return memo.album_tracks[key]
+
+async def tidal_search(spotify_track, rate_limiter, tidal_session: tidalapi.Session, memo: TidalSearchMemo | None = None) -> tidalapi.Track | None:
+    spotify_key = SpotifyMatchKey.from_track(spotify_track)
+    memo = memo if memo is not None else TidalSearchMemo()
 
-async def tidal_search(spotify_track, rate_limiter, tidal_session: tidalapi.Session) -> tidalapi.Track | None:
     def _search_for_track_in_album():
         # search for album name and first album artist
         if 'album' in spotify_track and 'artists' in spotify_track['album'] and len(spotify_track['album']['artists']):
             query = simple(spotify_track['album']['name']) + " " + simple(spotify_track['album']['artists'][0]['name'])
-            album_result = tidal_session.search(query, models=[tidalapi.album.Album])
-            for album in album_result['albums']:
+            for album in _search_tidal_albums(tidal_session, query, memo):
                 if album.num_tracks >= spotify_track['track_number'] and test_album_similarity(spotify_track['album'], album):
-                    album_tracks = album.tracks()
-                    if len(album_tracks) < spotify_track['track_number']:
-                        assert( not len(album_tracks) == album.num_tracks ) # incorrect metadata :(
-                        continue
-                    track = album_tracks[spotify_track['track_number'] - 1]
-                    if match(track, spotify_track):
-                        failure_cache.remove_match_failure(spotify_track['id'])
+                    track = _get_album_track(album, spotify_track['track_number'] - 1, memo)
+                    if not track:
+                        continue # incorrect metadata :(
+                    if match(TidalMatchKey.from_track(track), spotify_key):
                         return track
 
     def _search_for_standalone_track():
         # if album search fails then search for track name and first artist
         query = simple(spotify_track['name']) + ' ' + simple(spotify_track['artists'][0]['name'])
-        for track in tidal_session.search(query, models=[tidalapi.media.Track])['tracks']:
-            if match(track, spotify_track):
-                failure_cache.remove_match_failure(spotify_track['id'])
+        candidates = [(track, TidalMatchKey.from_track(track)) for track in tidal_session.search(query, models=[tidalapi.media.Track])['tracks']]
+        matches = [(track, key) for track, key in candidates if match(key, spotify_key)]
+        # a result with the same isrc is the same recording, whatever its name says
+        for track, key in matches:
+            if isrc_match(key, spotify_key):
                 return track
+        if matches:
+            # prefer the closest simplified name when the loose matching accepts several results, then the closest full name
+            # so that the version is taken into account, keeping the search order on ties
+            spotify_name = normalize(spotify_key.name)
+            return max(matches, key=lambda m: (fuzz.ratio(spotify_key.normalized_simple_name, simple(normalize(m[1].name))),
+                                               fuzz.ratio(spotify_name, normalize(m[1].name))))[0]
     await rate_limiter.acquire()
     album_search = await asyncio.to_thread( _search_for_track_in_album )
     if album_search:
         return album_search
     await rate_limiter.acquire()
-    track_search = await asyncio.to_thread( _search_for_standalone_track )
-    if track_search:
-        return track_search
+    return await asyncio.to_thread( _search_for_standalone_track )
 
-    # if none of the search modes succeeded then store the track id to the failure cache
-    failure_cache.cache_match_failure(spotify_track['id'])
+def _retry_after(e: Exception) -> float | None:
+    """ The delay in seconds asked for by the server, from tidalapi's TooManyRequests or a Retry-After response header """
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is None and getattr(e, 'response', None) is not None:
+        retry_after = e.response.headers.get('Retry-After')
+    try:
+        retry_after = float(retry_after)
+    except (TypeError, ValueError):
+        return None # missing, or given as an http date
+    # tidalapi uses -1 when the header was absent
+    return retry_after if retry_after >= 0 else None
 
 async def repeat_on_request_error(function, *args, remaining=5, **kwargs):
     # utility to repeat calling the function up to 5 times if an exception is thrown
-    try:
-        return await function(*args, **kwargs)
-    except (tidalapi.exceptions.TooManyRequests, requests.exceptions.RequestException) as e:
-        if remaining:
-            print(f"{str(e)} occurred, retrying {remaining} times")
-        else:
-            print(f"{str(e)} could not be recovered")
-
-        if isinstance(e, requests.exceptions.RequestException) and not e.response is None:
-            print(f"Response message: {e.response.text}")
-            print(f"Response headers: {e.response.headers}")
-
-        if not remaining:
-            print("Aborting sync")
-            print(f"The following arguments were provided:\n\n {str(args)}")
-            print(traceback.format_exc())
-            sys.exit(1)
-        sleep_schedule = {5: 1, 4:10, 3:60, 2:5*60, 1:10*60} # sleep variable length of time depending on retry number
-        time.sleep(sleep_schedule.get(remaining, 1))
-        return await repeat_on_request_error(function, *args, remaining=remaining-1, **kwargs)
-
+    sleep_schedule = {5: 1, 4:10, 3:60, 2:5*60, 1:10*60} # sleep variable length of time depending on retry number
+    for remaining in range(remaining, -1, -1):
+        try:
+            return await function(*args, **kwargs)
+        except (tidalapi.exceptions.TooManyRequests, requests.exceptions.RequestException) as e:
+            if remaining:
+                print(f"{str(e)} occurred, retrying {remaining} times")
+            else:
+                print(f"{str(e)} could not be recovered")
+
+            if isinstance(e, requests.exceptions.RequestException) and not e.response is None:
+                print(f"Response message: {e.response.text}")
+                print(f"Response headers: {e.response.headers}")
+
+            if not remaining:
+                print("Aborting sync")
+                print(f"The following arguments were provided:\n\n {str(args)}")
+                print(traceback.format_exc())
+                sys.exit(1)
+            # jitter the delay so that concurrent searches which failed together don't all retry at the same moment,
+            # waiting exactly as long as the server asks when it says so
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                await asyncio.sleep(retry_after + random.uniform(0, 1))
+            else:
+                await asyncio.sleep(sleep_schedule.get(remaining, 1) * random.uniform(0.5, 1.5))
 
-async def _fetch_all_from_spotify_in_chunks(fetch_function: Callable) -> List[dict]:
-    output = []
-    results = fetch_function(0)
-    output.extend([item['track'] for item in results['items'] if item['track'] is not None])
 
-    # Get all the remaining tracks in parallel
+async def _iter_pages_from_spotify(fetch_function: Callable) -> AsyncIterator[dict]:
+    """
+    Yields the pages in order as soon as they arrive, so each page can be processed and released while the rest are still loading
+    The first page is fetched to learn the total, then all the remaining pages are requested in parallel through the same session
+    """
+    results = await asyncio.to_thread(fetch_function, 0)
+    yield results
     if results['next']:
         offsets = [results['limit'] * n for n in range(1, math.ceil(results['total'] / results['limit']))]
-        extra_results = await atqdm.gather(
-            *[asyncio.to_thread(fetch_function, offset) for offset in offsets],
-            desc="Fetching additional data chunks"
-        )
-        for extra_result in extra_results:
-            output.extend([item['track'] for item in extra_result['items'] if item['track'] is not None])
+        with tqdm(desc="Fetching additional data chunks", total=len(offsets)) as progress:
+            tasks = deque(asyncio.ensure_future(asyncio.to_thread(fetch_function, offset)) for offset in offsets)
+            for task in tasks:
+                task.add_done_callback(lambda _: progress.update(1))
+            try:
+                while tasks:
+                    yield await tasks.popleft()
+            finally:
+                for task in tasks:
+                    task.cancel()
+
 
+async def _fetch_all_from_spotify_in_chunks(fetch_function: Callable) -> List[dict]:
+    output = []
+    async for results in _iter_pages_from_spotify(fetch_function):
+        # map and filter keep the per-item loop in C; removed tracks come back as None
+        output.extend(filter(None, map(itemgetter('track'), results['items'])))
     return output
 
 
 async def get_tracks_from_spotify_playlist(spotify_session: spotipy.Spotify, spotify_playlist):
     def _get_tracks_from_spotify_playlist(offset: int, spotify_session: spotipy.Spotify, playlist_id: str):
-        fields = "next,total,limit,items(track(name,album(name,artists),artists,track_number,duration_ms,id,external_ids(isrc)))"
+        fields = "next,total,limit,items(track(name,album(name,artists),artists,track_number,duration_ms,id,is_local,external_ids(isrc)))"
         return spotify_session.playlist_tracks(playlist_id=playlist_id, fields=fields, offset=offset)
 
     print(f"Loading tracks from Spotify playlist '{spotify_playlist['name']}'")
     return await _fetch_all_from_spotify_in_chunks(lambda offset, session=spotify_session: _get_tracks_from_spotify_playlist(offset=offset, spotify_session=session, playlist_id=spotify_playlist["id"]))
 
 
-def populate_track_match_cache(spotify_tracks_: Sequence[t_spotify.SpotifyTrack], tidal_tracks_: Sequence[tidalapi.Track]):
-    """ Populate the track match cache with all the existing tracks in Tidal playlist corresponding to Spotify playlist """
-    def _populate_one_track_from_spotify(spotify_track: t_spotify.SpotifyTrack):
-        for idx, tidal_track in list(enumerate(tidal_tracks)):
-            if tidal_track.available and match(tidal_track, spotify_track):
-                track_match_cache.insert((spotify_track['id'], tidal_track.id))
-                tidal_tracks.pop(idx)
+def populate_track_match_cache(spotify_tracks: Sequence[t_spotify.SpotifyTrack], tidal_tracks: Sequence[tidalapi.Track]) -> Mapping[str, int]:
+    """
+    Populate the track match cache with all the existing tracks in Tidal playlist corresponding to Spotify playlist
+    The matches are also returned, since the shared cache can be overwritten by other playlists syncing concurrently
+    """
+    def _insert(spotify_id: str, tidal_id: int):
+        track_match_cache.insert((spotify_id, tidal_id))
+        playlist_matches[spotify_id] = tidal_id
+
+    def _index_by_isrc(keys: Sequence[SpotifyMatchKey | TidalMatchKey]) -> Mapping[str, List[int]]:
+        index = defaultdict(list)
+        for idx, key in enumerate(keys):
+            if key.isrc:
+                index[key.isrc].append(idx)
+        return index
+
+    def _index_by_duration(keys: Sequence[SpotifyMatchKey | TidalMatchKey]) -> Mapping[int, List[int]]:
+        index = defaultdict(list)
+        for idx, key in enumerate(keys):
+            index[int(key.duration)].append(idx)
+        return index
+
+    def _candidates(key: SpotifyMatchKey | TidalMatchKey, by_isrc: Mapping[str, List[int]], by_duration: Mapping[int, List[int]]) -> Iterable[int]:
+        # tracks with an identical isrc first, then those in the 1s buckets which can be within the 2s duration tolerance, in their original order
+        nearby = sorted(chain.from_iterable(by_duration.get(int(key.duration) + offset, ()) for offset in range(-2, 3)))
+        # an isrc match is usually also in a nearby bucket, so drop the repeat rather than comparing the same pair twice
+        return dict.fromkeys(chain(by_isrc.get(key.isrc, ()), nearby))
+
+    def _populate_one_track_from_spotify(spotify_idx: int):
+        spotify_key = spotify_keys[spotify_idx]
+        for idx in _candidates(spotify_key, tidal_by_isrc, tidal_by_duration):
+            if idx not in matched_tidal and tidal_tracks[idx].available and match(tidal_keys[idx], spotify_key):
+                _insert(spotify_key.id, tidal_keys[idx].id)
+                matched_tidal.add(idx)
                 return
 
-    def _populate_one_track_from_tidal(tidal_track: tidalapi.Track):
-        for idx, spotify_track in list(enumerate(spotify_tracks)):
-            if tidal_track.available and match(tidal_track, spotify_track):
-                track_match_cache.insert((spotify_track['id'], tidal_track.id))
-                spotify_tracks.pop(idx)
+    def _populate_one_track_from_tidal(tidal_idx: int):
+        if not tidal_tracks[tidal_idx].available:
+            return
+        tidal_key = tidal_keys[tidal_idx]
+        for idx in _candidates(tidal_key, spotify_by_isrc, spotify_by_duration):
+            if idx not in matched_spotify and match(tidal_key, spotify_keys[idx]):
+                _insert(spotify_keys[idx].id, tidal_key.id)
+                matched_spotify.add(idx)
                 return
 
-    # make a copy of the tracks to avoid modifying original arrays
-    spotify_tracks = [t for t in spotify_tracks_]
-    tidal_tracks = [t for t in tidal_tracks_]
-
-    # first populate from the tidal tracks
-    for track in tidal_tracks:
-        _populate_one_track_from_tidal(track)
+    # matches from earlier runs to tracks which Tidal no longer offers are dropped, so that those tracks get searched for again
+    track_match_cache.remove_tidal_ids({t.id for t in tidal_tracks if not t.available})
+
+    # extract the fields used for matching once per track rather than once per candidate pair
+    spotify_keys = [SpotifyMatchKey.from_track(t) for t in spotify_tracks]
+    tidal_keys = [TidalMatchKey.from_track(t) for t in tidal_tracks]
+
+    # index both sides by isrc and duration so that only plausible candidates are compared instead of every pair
+    spotify_by_isrc = _index_by_isrc(spotify_keys)
+    spotify_by_duration = _index_by_duration(spotify_keys)
+    tidal_by_isrc = _index_by_isrc(tidal_keys)
+    tidal_by_duration = _index_by_duration(tidal_keys)
+
+    playlist_matches: dict[str, int] = {}
+    # track the indices which have already been matched rather than removing them from the sequences
+    matched_spotify: Set[int] = set()
+    matched_tidal: Set[int] = set()
+
+    # first pair up the tracks with identical isrcs in a single pass, so a looser match can't claim a track with an exact match
+    isrc_matched_tidal: Set[int] = set()
+    for isrc, tidal_indices in tidal_by_isrc.items():
+        available_tidal = [idx for idx in tidal_indices if tidal_tracks[idx].available]
+        for tidal_idx, spotify_idx in zip(available_tidal, [idx for idx in spotify_by_isrc.get(isrc, ()) if spotify_keys[idx].id]):
+            _insert(spotify_keys[spotify_idx].id, tidal_keys[tidal_idx].id)
+            matched_spotify.add(spotify_idx)
+            isrc_matched_tidal.add(tidal_idx)
+    # then populate from the rest of the tidal tracks
+    for idx in range(len(tidal_keys)):
+        if idx not in isrc_matched_tidal:
+            _populate_one_track_from_tidal(idx)
     # then populate from the subset of Spotify tracks that didn't match (to account for many-to-one style mappings)
-    for track in spotify_tracks:
-        _populate_one_track_from_spotify(track)
+    for idx in range(len(spotify_keys)):
+        if idx not in matched_spotify:
+            _populate_one_track_from_spotify(idx)
+    return playlist_matches
 
 def get_new_spotify_tracks(spotify_tracks: Sequence[t_spotify.SpotifyTrack]) -> List[t_spotify.SpotifyTrack]:
     ''' Extracts only the tracks that have not already been seen in our Tidal caches '''
-    results = []
-    for spotify_track in spotify_tracks:
-        if not spotify_track['id']: continue
-        if not track_match_cache.get(spotify_track['id']) and not failure_cache.has_match_failure(spotify_track['id']):
-            results.append(spotify_track)
-    return results
-
-def get_tracks_for_new_tidal_playlist(spotify_tracks: Sequence[t_spotify.SpotifyTrack]) -> Sequence[int]:
-    ''' gets list of corresponding tidal track ids for each spotify track, ignoring duplicates '''
-    output = []
-    seen_tracks = set()
-
-    for spotify_track in spotify_tracks:
-        if not spotify_track['id']: continue
-        tidal_id = track_match_cache.get(spotify_track['id'])
-        if tidal_id:
+    track_ids = {spotify_track['id'] for spotify_track in spotify_tracks if spotify_track['id']}
+    # look up all the tracks in each cache at once rather than querying the caches track by track
+    seen_ids = track_match_cache.has_matches(track_ids)
+    seen_ids.update(failure_cache.has_match_failures(track_ids - seen_ids))
+    return [spotify_track for spotify_track in spotify_tracks if spotify_track['id'] and not spotify_track['id'] in seen_ids]
+
+def get_tracks_for_new_tidal_playlist(spotify_tracks: Sequence[t_spotify.SpotifyTrack], playlist_matches: Mapping[str, int] | None = None) -> Sequence[int]:
+    ''' gets list of corresponding tidal track ids for each spotify track, ignoring duplicates, preferring the given playlist_matches over the cache '''
+    playlist_matches = playlist_matches or {}
+    tidal_ids = [(playlist_matches.get(spotify_track['id']) or track_match_cache.get(spotify_track['id'])) if spotify_track['id'] else None
+                 for spotify_track in spotify_tracks]
+    matched_ids = [tidal_id for tidal_id in tidal_ids if tidal_id]
+    output = list(dict.fromkeys(matched_ids))
+
+    # only walk the tracks again to report the duplicates if any were dropped
+    if len(output) < len(matched_ids):
+        seen_tracks = set()
+        for spotify_track, tidal_id in zip(spotify_tracks, tidal_ids):
+            if not tidal_id: continue
             if tidal_id in seen_tracks:
                 track_name = spotify_track['name']
                 artist_names = ', '.join([artist['name'] for artist in spotify_track['artists']])
-                print(f'Duplicate found: Track "{track_name}" by {artist_names} will be ignored') 
-            else:
-                output.append(tidal_id)
-                seen_tracks.add(tidal_id)
+                print(f'Duplicate found: Track "{track_name}" by {artist_names} will be ignored')
+            seen_tracks.add(tidal_id)
     return output
 
-async def search_new_tracks_on_tidal(tidal_session: tidalapi.Session, spotify_tracks: Sequence[t_spotify.SpotifyTrack], playlist_name: str, config: dict):
+class TokenBucket:
+    """
+    Token bucket rate limiter allowing bursts of up to capacity requests and a sustained rate of rate requests per second
+    The tokens are accounted for lazily on each acquire, so no background task is needed to refill the bucket
+    """
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # waiters queue on the lock, so tokens are handed out in the order they were requested
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def _is_searchable(spotify_track: t_spotify.SpotifyTrack) -> bool:
+    """ Local files and tracks without a name or artists can never be found on Tidal, so don't spend any requests on them """
+    return bool(spotify_track.get('name') and spotify_track.get('artists') and not spotify_track.get('is_local'))
+
+async def search_new_tracks_on_tidal(tidal_session: tidalapi.Session, spotify_tracks: Sequence[t_spotify.SpotifyTrack], playlist_name: str, config: dict, rate_limiter: TokenBucket | None = None):
     """ Generic function for searching for each item in a list of Spotify tracks which have not already been seen and adding them to the cache """
-    async def _run_rate_limiter(semaphore):
-        ''' Leaky bucket algorithm for rate limiting. Periodically releases items from semaphore at rate_limit'''
-        _sleep_time = config.get('max_concurrency', 10)/config.get('rate_limit', 10)/4 # aim to sleep approx time to drain 1/4 of 'bucket'
-        t0 = datetime.datetime.now()
-        while True:
-            await asyncio.sleep(_sleep_time)
-            t = datetime.datetime.now()
-            dt = (t - t0).total_seconds()
-            new_items = round(config.get('rate_limit', 10)*dt)
-            t0 = t
-            [semaphore.release() for i in range(new_items)] # leak new_items from the 'bucket'
-
     # Extract the new tracks that do not already exist in the old tidal tracklist
-    tracks_to_search = get_new_spotify_tracks(spotify_tracks)
+    tracks_to_search = [t for t in get_new_spotify_tracks(spotify_tracks) if _is_searchable(t)]
+
+    # A recording found by an earlier search can turn up again under another spotify id (e.g. on a compilation), so
+    # reuse the match for its isrc instead of searching again
+    reused_ids = set()
+    for spotify_track in tracks_to_search:
+        tidal_id = track_match_cache.get_by_isrc(spotify_track['external_ids'].get('isrc'))
+        if tidal_id:
+            track_match_cache.insert( (spotify_track['id'], tidal_id) )
+            reused_ids.add(spotify_track['id'])
+    if reused_ids:
+        tracks_to_search = [t for t in tracks_to_search if t['id'] not in reused_ids]
+        track_match_cache.persist(reused_ids)
+        failure_cache.remove_match_failures(reused_ids)
     if not tracks_to_search:
         return
 
     # Search for each of the tracks on Tidal concurrently
     task_description = "Searching Tidal for {}/{} tracks in Spotify playlist '{}'".format(len(tracks_to_search), len(spotify_tracks), playlist_name)
-    semaphore = asyncio.Semaphore(config.get('max_concurrency', 10))
-    rate_limiter_task = asyncio.create_task(_run_rate_limiter(semaphore))
-    search_results = await atqdm.gather( *[ repeat_on_request_error(tidal_search, t, semaphore, tidal_session) for t in tracks_to_search ], desc=task_description )
-    rate_limiter_task.cancel()
+    rate_limiter = rate_limiter or TokenBucket(capacity=config.get('max_concurrency', 10), rate=config.get('rate_limit', 10))
 
-    # Add the search results to the cache
+    # Tracks with the same isrc are the same recording under different spotify ids (e.g. a single and its album version),
+    # so search once for each recording and share the result
+    groups: dict[str, List[int]] = defaultdict(list)
     for idx, spotify_track in enumerate(tracks_to_search):
-        if search_results[idx]:
-            track_match_cache.insert( (spotify_track['id'], search_results[idx].id) )
-        else:
-            color = ('\033[91m', '\033[0m')
-            print(color[0] + f"Could not find track {spotify_track['id']}: {','.join([a['name'] for a in spotify_track['artists']])} - {spotify_track['name']}" + color[1])
-
-async def sync_playlist(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, spotify_playlist, tidal_playlist: tidalapi.Playlist | None, config: dict):
+        groups[spotify_track['external_ids'].get('isrc') or spotify_track['id']].append(idx)
+
+    # album and album track lookups are shared by the searches of this call only, so nothing outlives it or pins the session
+    memo = TidalSearchMemo()
+
+    async def _search_for_group(group: List[int]):
+        return group, await repeat_on_request_error(tidal_search, tracks_to_search[group[0]], rate_limiter, tidal_session, memo)
+
+    # Consume the results as they complete so the progress bar reflects real progress, and add matches to the cache as they arrive
+    # The bar counts tracks like its description, so it advances by the size of each group
+    search_results: List[tidalapi.Track | None] = [None] * len(tracks_to_search)
+    with tqdm(desc=task_description, total=len(tracks_to_search)) as progress:
+        for future in asyncio.as_completed([ _search_for_group(group) for group in groups.values() ]):
+            group, result = await future
+            for idx in group:
+                search_results[idx] = result
+                if result:
+                    track_match_cache.insert( (tracks_to_search[idx]['id'], result.id) )
+                    if isrc := tracks_to_search[idx]['external_ids'].get('isrc'):
+                        track_match_cache.insert_isrc( (isrc, result.id) )
+            progress.update(len(group))
+
+    # Update the caches in one transaction each: tracks that were found are stored for the next run and are no longer
+    # failures, and tracks where none of the search modes succeeded are stored in the failure cache
+    found_ids = {t['id'] for t, result in zip(tracks_to_search, search_results) if result}
+    found_isrcs = {t['external_ids'].get('isrc') for t, result in zip(tracks_to_search, search_results) if result}
+    track_match_cache.persist(found_ids, found_isrcs)
+    failure_cache.remove_match_failures(found_ids)
+    failure_cache.cache_match_failures({t['id'] for t, result in zip(tracks_to_search, search_results) if not result})
+
+    # Report the tracks which could not be found, in a single write rather than one per track
+    color = ('\033[91m', '\033[0m')
+    not_found = [color[0] + f"Could not find track {spotify_track['id']}: {','.join([a['name'] for a in spotify_track['artists']])} - {spotify_track['name']}" + color[1]
+                 for spotify_track, result in zip(tracks_to_search, search_results) if not result]
+    if not_found:
+        print("\n".join(not_found))
+
+async def sync_playlist(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, spotify_playlist, tidal_playlist: tidalapi.Playlist | None, config: dict, rate_limiter: TokenBucket | None = None):
     """ sync given playlist to tidal """
     # Create a new Tidal playlist if required
     if not tidal_playlist:
         print(f"No playlist found on Tidal corresponding to Spotify playlist: '{spotify_playlist['name']}', creating new playlist")
-        tidal_playlist =  tidal_session.user.create_playlist(spotify_playlist['name'], spotify_playlist['description'])
+        tidal_playlist = await asyncio.to_thread(tidal_session.user.create_playlist, spotify_playlist['name'], spotify_playlist['description'])
 
     # Extract the new tracks from the playlist that we haven't already seen before
     spotify_tracks = await get_tracks_from_spotify_playlist(spotify_session, spotify_playlist)
-    old_tidal_tracks = await get_all_playlist_tracks(tidal_playlist)
-    populate_track_match_cache(spotify_tracks, old_tidal_tracks)
-    await search_new_tracks_on_tidal(tidal_session, spotify_tracks, spotify_playlist['name'], config)
-    new_tidal_track_ids = get_tracks_for_new_tidal_playlist(spotify_tracks)
-
-    # Update the Tidal playlist if there are changes
+    # a newly created or empty playlist has no tracks to compare against, so don't request them
+    old_tidal_tracks = await get_all_playlist_tracks(tidal_playlist) if tidal_playlist.num_tracks else []
+    # keep this playlist's own matches, as other playlists populating the shared cache during the search can overwrite them
+    playlist_matches = populate_track_match_cache(spotify_tracks, old_tidal_tracks)
+    await search_new_tracks_on_tidal(tidal_session, spotify_tracks, spotify_playlist['name'], config, rate_limiter)
+    new_tidal_track_ids = get_tracks_for_new_tidal_playlist(spotify_tracks, playlist_matches)
+
+    # Update the Tidal playlist if there are changes, in a worker thread so that other playlists can progress meanwhile
     old_tidal_track_ids = [t.id for t in old_tidal_tracks]
     if new_tidal_track_ids == old_tidal_track_ids:
-        print("No changes to write to Tidal playlist")
+        print(f"No changes to write to Tidal playlist '{spotify_playlist['name']}'")
     elif new_tidal_track_ids[:len(old_tidal_track_ids)] == old_tidal_track_ids:
         # Append new tracks to the existing playlist if possible
-        add_multiple_tracks_to_playlist(tidal_playlist, new_tidal_track_ids[len(old_tidal_track_ids):])
+        await asyncio.to_thread(add_multiple_tracks_to_playlist, tidal_playlist, new_tidal_track_ids[len(old_tidal_track_ids):])
     else:
         # Erase old playlist and add new tracks from scratch if any reordering occured
-        clear_tidal_playlist(tidal_playlist)
-        add_multiple_tracks_to_playlist(tidal_playlist, new_tidal_track_ids)
+        def _rewrite_playlist():
+            clear_tidal_playlist(tidal_playlist)
+            add_multiple_tracks_to_playlist(tidal_playlist, new_tidal_track_ids)
+        await asyncio.to_thread(_rewrite_playlist)
+
+async def sync_playlists(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, playlists, config: dict):
+    """ sync the given playlists to tidal concurrently, sharing a single rate limit so the total request rate stays bounded """
+    rate_limiter = TokenBucket(capacity=config.get('max_concurrency', 10), rate=config.get('rate_limit', 10))
+    semaphore = asyncio.Semaphore(config.get('playlist_concurrency', 4))
+
+    async def _sync_playlist(spotify_playlist, tidal_playlist: tidalapi.Playlist | None):
+        async with semaphore:
+            await sync_playlist(spotify_session, tidal_session, spotify_playlist, tidal_playlist, config, rate_limiter)
+
+    await asyncio.gather(*[_sync_playlist(spotify_playlist, tidal_playlist) for spotify_playlist, tidal_playlist in playlists])
 
 async def sync_favorites(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, config: dict):
     """ sync user favorites to tidal """
@@ -329,13 +599,18 @@ async def sync_favorites(spotify_session: spotipy.Spotify, tidal_session: tidala
     else:
         print("No new tracks to add to Tidal favorites")
 
+def _run_with_thread_pool(main, config: dict):
+    ''' Runs the coroutine in a new event loop whose blocking calls share a thread pool sized to the max_concurrency setting '''
+    async def _main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=config.get('max_concurrency', 10)))
+        return await main
+    return asyncio.run(_main())
+
 def sync_playlists_wrapper(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, playlists, config: dict):
-  for spotify_playlist, tidal_playlist in playlists:
-    # sync the spotify playlist to tidal
-    asyncio.run(sync_playlist(spotify_session, tidal_session, spotify_playlist, tidal_playlist, config) )
+    _run_with_thread_pool(sync_playlists(spotify_session, tidal_session, playlists, config), config)
 
 def sync_favorites_wrapper(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, config):
-    asyncio.run(main=sync_favorites(spotify_session=spotify_session, tidal_session=tidal_session, config=config))
+    _run_with_thread_pool(sync_favorites(spotify_session=spotify_session, tidal_session=tidal_session, config=config), config)
 
 def get_tidal_playlists_wrapper(tidal_session: tidalapi.Session) -> Mapping[str, tidalapi.Playlist]:
     tidal_playlists = asyncio.run(get_all_playlists(tidal_session.user))
@@ -361,34 +636,31 @@ async def get_playlists_from_spotify(spotify_session: spotipy.Spotify, config):
     # get all the user playlists from the Spotify account
     playlists = []
     print("Loading Spotify playlists")
-    results = spotify_session.user_playlists(config['spotify']['username'])
     exclude_list = set([x.split(':')[-1] for x in config.get('excluded_playlists', [])])
-    playlists.extend([p for p in results['items'] if p['owner']['id'] == config['spotify']['username'] and not p['id'] in exclude_list])
-
-    # get all the remaining playlists in parallel
-    if results['next']:
-        offsets = [ results['limit'] * n for n in range(1, math.ceil(results['total']/results['limit'])) ]
-        extra_results = await atqdm.gather( *[asyncio.to_thread(spotify_session.user_playlists, config['spotify']['username'], offset=offset) for offset in offsets ] )
-        for extra_result in extra_results:
-            playlists.extend([p for p in extra_result['items'] if p['owner']['id'] == config['spotify']['username'] and not p['id'] in exclude_list])
+    async for results in _iter_pages_from_spotify(lambda offset: spotify_session.user_playlists(config['spotify']['username'], offset=offset)):
+        playlists.extend(p for p in results['items'] if p['owner']['id'] == config['spotify']['username'] and not p['id'] in exclude_list)
     return playlists
 
 def get_playlists_from_config(spotify_session: spotipy.Spotify, tidal_session: tidalapi.Session, config):
     # get the list of playlist sync mappings from the configuration file
     def get_playlist_ids(config):
         return [(item['spotify_id'], item['tidal_id']) for item in config['sync_playlists']]
-    output = []
-    for spotify_id, tidal_id in get_playlist_ids(config=config):
+    def get_spotify_playlist(spotify_id: str):
         try:
-            spotify_playlist = spotify_session.playlist(playlist_id=spotify_id)
+            # only request the fields used for syncing, the tracks themselves are fetched in pages later
+            return spotify_session.playlist(playlist_id=spotify_id, fields="id,name,description")
         except spotipy.SpotifyException as e:
             print(f"Error getting Spotify playlist {spotify_id}")
             raise e
+    def get_tidal_playlist(tidal_id: str):
         try:
-            tidal_playlist = tidal_session.playlist(playlist_id=tidal_id)
+            return tidal_session.playlist(playlist_id=tidal_id)
         except Exception as e:
             print(f"Error getting Tidal playlist {tidal_id}")
             raise e
-        output.append((spotify_playlist, tidal_playlist))
-    return output
-
+    async def get_playlists():
+        # look up all the playlists concurrently rather than one after another
+        return await asyncio.gather(*[
+            asyncio.gather(asyncio.to_thread(get_spotify_playlist, spotify_id), asyncio.to_thread(get_tidal_playlist, tidal_id))
+            for spotify_id, tidal_id in get_playlist_ids(config=config)])
+    return [(spotify_playlist, tidal_playlist) for spotify_playlist, tidal_playlist in asyncio.run(get_playlists())]
@@ -1,12 +1,15 @@
 # tests/unit/test_auth.py
 
+import http.server
 import pytest
+import requests
+import threading
 import spotipy
 import tidalapi
 import yaml
 import sys
 from unittest import mock
-from spotify_to_tidal.auth import open_spotify_session, open_tidal_session, SPOTIFY_SCOPES
+from spotify_to_tidal.auth import open_spotify_session, open_tidal_session, size_connection_pool, SPOTIFY_SCOPES
 
 
 def test_open_spotify_session(mocker):
@@ -43,8 +46,11 @@ def test_open_spotify_session(mocker):
         requests_timeout=2,
     )
 
-    # Assert that the Spotify instance was created
-    mock_spotify_instance.assert_called_once_with(oauth_manager=mock_oauth_instance)
+    # Assert that the Spotify instance was created with a pooled requests session
+    mock_spotify_instance.assert_called_once_with(oauth_manager=mock_oauth_instance, requests_session=mock.ANY)
+    requests_session = mock_spotify_instance.call_args.kwargs["requests_session"]
+    assert isinstance(requests_session, requests.Session)
+    assert requests_session.get_adapter("https://api.spotify.com")._pool_maxsize == 10
     assert spotify_instance == mock_spotify_instance.return_value
 
 
@@ -71,3 +77,46 @@ def test_open_spotify_session_oauth_error(mocker):
     # Call the function under test and assert sys.exit is called
     open_spotify_session(mock_config)
     mock_sys_exit.assert_called_once()
+
+
+def test_size_connection_pool():
+    session = requests.Session()
+
+    size_connection_pool(session, 32)
+
+    adapter = session.get_adapter("https://api.tidal.com/v1/search")
+    assert adapter._pool_maxsize == 32
+    assert adapter.max_retries.total == 3
+    assert 503 in adapter.max_retries.status_forcelist
+    assert 429 not in adapter.max_retries.status_forcelist
+    assert not adapter.max_retries.is_retry("GET", 429, has_retry_after=True)
+    assert not adapter.max_retries.is_retry("POST", 503)
+
+
+def test_size_connection_pool_passes_rate_limited_response_through(mocker):
+    class RateLimitedHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(429)
+            self.send_header("Retry-After", "7")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sleep = mocker.patch("urllib3.util.retry.time.sleep")
+    session = requests.Session()
+    size_connection_pool(session, 4)
+
+    try:
+        response = session.get(f"http://127.0.0.1:{server.server_address[1]}/search")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # the adapter hands the 429 and its Retry-After to the caller without waiting itself
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+    sleep.assert_not_called()
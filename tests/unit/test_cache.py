@@ -45,6 +45,17 @@ def test_has_match_failure(in_memory_db, mocker):
     failure_db.cache_match_failure(track_id)
 
     assert failure_db.has_match_failure(track_id) is True
+    assert failure_db.has_match_failure("other_track") is False
+
+
+def test_known_failures_loaded_from_database(in_memory_db, mocker):
+    mocker.patch(
+        "spotify_to_tidal.cache.sqlalchemy.create_engine", return_value=in_memory_db
+    )
+    MatchFailureDatabase().cache_match_failure("test_track")
+
+    # a new instance should pick up the failures already stored in the database
+    assert MatchFailureDatabase().has_match_failure("test_track") is True
 
 
 def test_remove_match_failure(in_memory_db, mocker):
@@ -66,6 +77,35 @@ def test_remove_match_failure(in_memory_db, mocker):
         assert result is None
 
 
+def test_has_match_failures(in_memory_db, mocker):
+    mocker.patch(
+        "spotify_to_tidal.cache.sqlalchemy.create_engine", return_value=in_memory_db
+    )
+    failure_db = MatchFailureDatabase()
+
+    failure_db.cache_match_failure("failed_track_1")
+    failure_db.cache_match_failure("failed_track_2")
+
+    assert failure_db.has_match_failures(
+        ["failed_track_1", "failed_track_2", "other_track"], chunk_size=2
+    ) == {"failed_track_1", "failed_track_2"}
+    assert failure_db.has_match_failures([]) == set()
+
+
+def test_cache_and_remove_match_failures(in_memory_db, mocker):
+    mocker.patch(
+        "spotify_to_tidal.cache.sqlalchemy.create_engine", return_value=in_memory_db
+    )
+    failure_db = MatchFailureDatabase()
+
+    failure_db.cache_match_failure("existing_track")
+    failure_db.cache_match_failures(["existing_track", "new_track"])
+    assert failure_db.has_match_failures(["existing_track", "new_track"]) == {"existing_track", "new_track"}
+
+    failure_db.remove_match_failures(["existing_track", "new_track"], chunk_size=1)
+    assert failure_db.has_match_failures(["existing_track", "new_track"]) == set()
+
+
 # Test TrackMatchCache
 def test_track_match_cache_insert():
     track_cache = TrackMatchCache()
@@ -77,4 +117,80 @@ def test_track_match_cache_get():
     track_cache = TrackMatchCache()
     track_cache.insert(("spotify_id", 123))
     assert track_cache.get("spotify_id") == 123
-    assert track_cache.get("nonexistent_id") is None
\ No newline at end of file
+    assert track_cache.get("nonexistent_id") is None
+
+
+def test_track_match_cache_has_matches():
+    track_cache = TrackMatchCache()
+    track_cache.insert(("spotify_id", 123))
+    assert track_cache.has_matches(["spotify_id", "nonexistent_id"]) == {"spotify_id"}
+
+
+def test_track_match_cache_instances_are_independent():
+    track_cache = TrackMatchCache()
+    track_cache.insert(("spotify_id", 123))
+    assert TrackMatchCache().get("spotify_id") is None
+
+
+def test_track_match_cache_persist(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    track_cache = TrackMatchCache(filename)
+    track_cache.insert(("spotify_1", 1))
+    track_cache.insert(("spotify_2", 2))
+    track_cache.persist(["spotify_1", "nonexistent_id"])
+    track_cache.insert(("spotify_1", 3))
+    track_cache.persist(["spotify_1"])
+
+    reloaded_cache = TrackMatchCache(filename)
+    assert reloaded_cache.get("spotify_1") == 3
+    assert reloaded_cache.get("spotify_2") is None
+
+
+def test_track_match_cache_persist_isrc(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    track_cache = TrackMatchCache(filename)
+    track_cache.insert_isrc(("ISRC1", 1))
+    track_cache.insert_isrc(("ISRC2", 2))
+    track_cache.persist([], ["ISRC1", None])
+
+    reloaded_cache = TrackMatchCache(filename)
+    assert reloaded_cache.get_by_isrc("ISRC1") == 1
+    assert reloaded_cache.get_by_isrc("ISRC2") is None
+
+
+def test_track_match_cache_expires_old_matches(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    track_cache = TrackMatchCache(filename)
+    track_cache.insert(("spotify_1", 1))
+    track_cache.insert_isrc(("ISRC1", 1))
+    track_cache.persist(["spotify_1"], ["ISRC1"])
+
+    assert TrackMatchCache(filename).get("spotify_1") == 1
+    expired_cache = TrackMatchCache(filename, max_age=datetime.timedelta(0))
+    assert expired_cache.get("spotify_1") is None
+    assert expired_cache.get_by_isrc("ISRC1") is None
+    assert TrackMatchCache(filename).get("spotify_1") is None
+
+
+def test_track_match_cache_remove_tidal_ids(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    track_cache = TrackMatchCache(filename)
+    track_cache.insert(("spotify_1", 1))
+    track_cache.insert(("spotify_2", 2))
+    track_cache.insert_isrc(("ISRC1", 1))
+    track_cache.persist(["spotify_1", "spotify_2"], ["ISRC1"])
+
+    track_cache.remove_tidal_ids([1])
+
+    assert track_cache.get("spotify_1") is None
+    assert track_cache.get_by_isrc("ISRC1") is None
+    reloaded_cache = TrackMatchCache(filename)
+    assert reloaded_cache.get("spotify_1") is None
+    assert reloaded_cache.get_by_isrc("ISRC1") is None
+    assert reloaded_cache.get("spotify_2") == 2
+
+
+def test_database_uses_write_ahead_log(tmp_path):
+    failure_db = MatchFailureDatabase(str(tmp_path / "cache.db"))
+    with failure_db.engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
@@ -0,0 +1,357 @@
+# tests/unit/test_sync.py
+
+import asyncio
+import pytest
+import requests
+from unittest import mock
+from spotify_to_tidal.cache import TrackMatchCache
+from spotify_to_tidal.sync import (
+    normalize,
+    simple,
+    split_artist_name,
+    match,
+    populate_track_match_cache,
+    _is_searchable,
+    tidal_search,
+    repeat_on_request_error,
+    search_new_tracks_on_tidal,
+    sync_playlists,
+    get_playlists_from_config,
+    get_tracks_for_new_tidal_playlist,
+    TokenBucket,
+    TidalSearchMemo,
+    SpotifyMatchKey,
+    TidalMatchKey,
+)
+
+
+def make_spotify_track(track_id, name, artists, duration_ms, isrc=None):
+    return {
+        "id": track_id,
+        "name": name,
+        "artists": [{"name": artist} for artist in artists],
+        "duration_ms": duration_ms,
+        "external_ids": {"isrc": isrc} if isrc else {},
+    }
+
+
+def make_tidal_track(track_id, name, artists, duration, isrc=None, version=None):
+    track = mock.Mock()
+    track.id = track_id
+    track.name = name
+    track.version = version
+    track.artists = [mock.Mock() for _ in artists]
+    for artist, artist_name in zip(track.artists, artists):
+        artist.name = artist_name
+    track.duration = duration
+    track.isrc = isrc
+    track.available = True
+    return track
+
+
+def test_normalize():
+    assert normalize("Beyoncé") == "Beyonce"
+    assert normalize("Sigur Rós") == "Sigur Ros"
+    assert normalize("plain ascii") == "plain ascii"
+
+
+def test_simple():
+    assert simple("Song Title - Remastered 2011") == "Song Title"
+    assert simple("Song Title (Live) [Bonus]") == "Song Title"
+
+
+def test_split_artist_name():
+    assert split_artist_name("A & B, C") == ["A ", " B", " C"]
+    assert split_artist_name("Artist") == ["Artist"]
+
+
+def test_match_isrc():
+    spotify_track = make_spotify_track("spotify_id", "Song", ["Artist"], 200000, isrc="ISRC1")
+    tidal_track = make_tidal_track(1, "Other Song", ["Other Artist"], 100, isrc="ISRC1")
+    assert match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+
+def test_match_metadata():
+    spotify_track = make_spotify_track("spotify_id", "Café Song - Remastered", ["Björk & Friend"], 200000)
+    tidal_track = make_tidal_track(1, "Cafe Song", ["Bjork"], 201)
+    assert match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+    # the duration must match to within 2 seconds
+    tidal_track.duration = 203
+    assert not match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+
+def test_match_spelling_difference():
+    spotify_track = make_spotify_track("spotify_id", "Dont Stop Me Now", ["Queen"], 200000)
+    tidal_track = make_tidal_track(1, "Don't Stop Me Now", ["Queen"], 200)
+    assert match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+    tidal_track.name = "Stop"
+    assert not match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+    spotify_track = make_spotify_track("spotify_id", "Mr. Brightside", ["The Killers"], 200000)
+    tidal_track = make_tidal_track(1, "Mr Brightside", ["The Killers"], 200)
+    assert match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+
+@pytest.mark.parametrize("spotify_name, tidal_name", [
+    ("Symphony No. 5", "Symphony No. 6"),
+    ("Prelude in C major", "Prelude in C minor"),
+    ("Interlude 2", "Interlude 3"),
+    ("Chapter 12", "Chapter 13"),
+    ("Love You", "You Love"),
+])
+def test_match_different_works(spotify_name, tidal_name):
+    spotify_track = make_spotify_track("spotify_id", spotify_name, ["Artist"], 200000)
+    tidal_track = make_tidal_track(1, tidal_name, ["Artist"], 200)
+    assert not match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+
+def test_match_artist_spelling_difference():
+    spotify_track = make_spotify_track("spotify_id", "Song", ["Jay-Z"], 200000)
+    tidal_track = make_tidal_track(1, "Song", ["JAY Z"], 200)
+    assert match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+    tidal_track = make_tidal_track(1, "Song", ["Drake Bell"], 200)
+    assert not match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+
+def test_match_remix_exclusion():
+    spotify_track = make_spotify_track("spotify_id", "Song", ["Artist"], 200000)
+    tidal_track = make_tidal_track(1, "Song", ["Artist"], 200, version="Remix")
+    assert not match(TidalMatchKey.from_track(tidal_track), SpotifyMatchKey.from_track(spotify_track))
+
+
+def test_populate_track_match_cache(mocker):
+    track_cache = TrackMatchCache()
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+
+    spotify_tracks = [
+        make_spotify_track("spotify_1", "First", ["Artist"], 100000, isrc="ISRC1"),
+        make_spotify_track("spotify_2", "Second", ["Artist"], 200000),
+        make_spotify_track("spotify_3", "Third", ["Artist"], 300000),
+    ]
+    tidal_tracks = [
+        make_tidal_track(2, "Second", ["Artist"], 200),
+        make_tidal_track(1, "Renamed", ["Artist"], 100, isrc="ISRC1"),
+    ]
+    populate_track_match_cache(spotify_tracks, tidal_tracks)
+
+    assert track_cache.get("spotify_1") == 1
+    assert track_cache.get("spotify_2") == 2
+    assert track_cache.get("spotify_3") is None
+
+
+def test_populate_track_match_cache_prefers_isrc(mocker):
+    track_cache = TrackMatchCache()
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+
+    spotify_tracks = [make_spotify_track("spotify_1", "Song", ["Artist"], 200000, isrc="ISRC1")]
+    tidal_tracks = [
+        make_tidal_track(1, "Song", ["Artist"], 200),
+        make_tidal_track(2, "Song - Remastered", ["Artist"], 200, isrc="ISRC1"),
+    ]
+    populate_track_match_cache(spotify_tracks, tidal_tracks)
+
+    assert track_cache.get("spotify_1") == 2
+
+
+def test_populate_track_match_cache_drops_unavailable_matches(mocker):
+    track_cache = TrackMatchCache()
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+    track_cache.insert(("spotify_1", 1))
+    track_cache.insert_isrc(("ISRC1", 1))
+    tidal_track = make_tidal_track(1, "Song", ["Artist"], 200, isrc="ISRC1")
+    tidal_track.available = False
+
+    populate_track_match_cache([make_spotify_track("spotify_1", "Song", ["Artist"], 200000, isrc="ISRC1")], [tidal_track])
+
+    assert track_cache.get("spotify_1") is None
+    assert track_cache.get_by_isrc("ISRC1") is None
+
+
+def test_is_searchable():
+    assert _is_searchable(make_spotify_track("spotify_id", "Song", ["Artist"], 200000))
+    assert not _is_searchable(make_spotify_track("spotify_id", "", ["Artist"], 200000))
+    assert not _is_searchable(make_spotify_track("spotify_id", "Song", [], 200000))
+    local_track = make_spotify_track("spotify_id", "Song", ["Artist"], 200000)
+    local_track["is_local"] = True
+    assert not _is_searchable(local_track)
+
+
+def test_tidal_search_reuses_album_searches():
+    album_tracks = [make_tidal_track(i, f"Song {i}", ["Artist"], 200 + i) for i in range(1, 3)]
+    album = mock.Mock()
+    album.id = 10
+    album.name = "Album"
+    album.artists = album_tracks[0].artists
+    album.num_tracks = len(album_tracks)
+    album.tracks.side_effect = lambda limit, offset: album_tracks[offset:offset + limit]
+    tidal_session = mock.Mock()
+    tidal_session.search.return_value = {"albums": [album]}
+    memo = TidalSearchMemo()
+
+    for track_number in range(1, 3):
+        spotify_track = make_spotify_track(f"spotify_{track_number}", f"Song {track_number}", ["Artist"], (200 + track_number) * 1000)
+        spotify_track["album"] = {"name": "Album", "artists": [{"name": "Artist"}]}
+        spotify_track["track_number"] = track_number
+        result = asyncio.run(tidal_search(spotify_track, TokenBucket(capacity=1, rate=1), tidal_session, memo))
+        assert result is album_tracks[track_number - 1]
+
+    tidal_session.search.assert_called_once()
+    assert album.tracks.call_args_list == [mock.call(limit=1, offset=0), mock.call(limit=1, offset=1)]
+
+def test_tidal_search_reuses_album_tracks_within_a_memo():
+    album_track = make_tidal_track(1, "Song", ["Artist"], 200)
+    album = mock.Mock()
+    album.id = 10
+    album.name = "Album"
+    album.artists = album_track.artists
+    album.num_tracks = 1
+    album.tracks.return_value = [album_track]
+    tidal_session = mock.Mock()
+    tidal_session.search.return_value = {"albums": [album]}
+    spotify_track = make_spotify_track("spotify_id", "Song", ["Artist"], 200000)
+    spotify_track["album"] = {"name": "Album", "artists": [{"name": "Artist"}]}
+    spotify_track["track_number"] = 1
+
+    memo = TidalSearchMemo()
+    for _ in range(2):
+        assert asyncio.run(tidal_search(spotify_track, TokenBucket(capacity=1, rate=1), tidal_session, memo)) is album_track
+    assert album.tracks.call_count == 1
+
+    # a new memo starts empty, so nothing is kept between separate runs
+    assert asyncio.run(tidal_search(spotify_track, TokenBucket(capacity=1, rate=1), tidal_session, TidalSearchMemo())) is album_track
+    assert album.tracks.call_count == 2
+
+
+def test_sync_playlists_shares_rate_limiter(mocker):
+    sync_playlist = mocker.patch("spotify_to_tidal.sync.sync_playlist", new_callable=mock.AsyncMock)
+    playlists = [({"name": "First"}, None), ({"name": "Second"}, None)]
+
+    asyncio.run(sync_playlists(mock.Mock(), mock.Mock(), playlists, {"playlist_concurrency": 2}))
+
+    assert [call.args[2] for call in sync_playlist.call_args_list] == [{"name": "First"}, {"name": "Second"}]
+    rate_limiters = {id(call.args[5]) for call in sync_playlist.call_args_list}
+    assert len(rate_limiters) == 1
+
+
+def test_get_playlists_from_config():
+    spotify_session = mock.Mock()
+    spotify_session.playlist.side_effect = lambda playlist_id, fields: {"id": playlist_id}
+    tidal_session = mock.Mock()
+    tidal_session.playlist.side_effect = lambda playlist_id: f"tidal {playlist_id}"
+    config = {"sync_playlists": [{"spotify_id": "a", "tidal_id": "1"}, {"spotify_id": "b", "tidal_id": "2"}]}
+
+    assert get_playlists_from_config(spotify_session, tidal_session, config) == [({"id": "a"}, "tidal 1"), ({"id": "b"}, "tidal 2")]
+
+
+def test_get_tracks_for_new_tidal_playlist(mocker, capsys):
+    track_cache = TrackMatchCache()
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+    track_cache.insert(("spotify_1", 1))
+    track_cache.insert(("spotify_2", 2))
+    track_cache.insert(("spotify_3", 1))
+    spotify_tracks = [
+        make_spotify_track("spotify_2", "Second", ["Artist"], 200000),
+        make_spotify_track(None, "Local", ["Artist"], 200000),
+        make_spotify_track("spotify_1", "First", ["Artist"], 100000),
+        make_spotify_track("spotify_4", "Unmatched", ["Artist"], 100000),
+        make_spotify_track("spotify_3", "First Again", ["Artist"], 100000),
+    ]
+
+    assert get_tracks_for_new_tidal_playlist(spotify_tracks) == [2, 1]
+    assert 'Duplicate found: Track "First Again" by Artist will be ignored' in capsys.readouterr().out
+
+
+def test_get_tracks_for_new_tidal_playlist_keeps_playlist_matches(mocker):
+    track_cache = TrackMatchCache()
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+    spotify_tracks = [make_spotify_track("spotify_1", "Song", ["Artist"], 200000)]
+
+    playlist_matches = populate_track_match_cache(spotify_tracks, [make_tidal_track(1, "Song", ["Artist"], 200)])
+    # another playlist syncing meanwhile matches the same Spotify track to its own copy on Tidal
+    populate_track_match_cache(spotify_tracks, [make_tidal_track(2, "Song", ["Artist"], 200)])
+
+    assert playlist_matches == {"spotify_1": 1}
+    assert get_tracks_for_new_tidal_playlist(spotify_tracks, playlist_matches) == [1]
+
+
+def test_tidal_search_prefers_closest_name():
+    spotify_track = make_spotify_track("spotify_id", "Song", ["Artist"], 200000)
+    tidal_tracks = [
+        make_tidal_track(1, "Song (Karaoke Version)", ["Artist"], 200),
+        make_tidal_track(2, "Song", ["Artist"], 200),
+        make_tidal_track(3, "Song", ["Artist"], 200),
+    ]
+    tidal_session = mock.Mock()
+    tidal_session.search.return_value = {"tracks": tidal_tracks}
+
+    result = asyncio.run(tidal_search(spotify_track, TokenBucket(capacity=2, rate=1), tidal_session))
+
+    assert result is tidal_tracks[1]
+
+
+@pytest.mark.parametrize("isrc_name, other_name", [
+    ("Song (Remastered 2011)", "Song"),
+    ("Song (2011 Remaster)", "Song (Remastered 2011)"),
+])
+def test_tidal_search_prefers_isrc_match(isrc_name, other_name):
+    spotify_track = make_spotify_track("spotify_id", "Song - Remastered 2011", ["Artist"], 200000, isrc="ISRC1")
+    tidal_tracks = [
+        make_tidal_track(2, other_name, ["Artist"], 200, isrc="ISRC2"),
+        make_tidal_track(1, isrc_name, ["Artist"], 200, isrc="ISRC1"),
+    ]
+    tidal_session = mock.Mock()
+    tidal_session.search.return_value = {"tracks": tidal_tracks}
+
+    result = asyncio.run(tidal_search(spotify_track, TokenBucket(capacity=2, rate=1), tidal_session))
+
+    assert result is tidal_tracks[1]
+
+
+def test_search_new_tracks_on_tidal_reuses_isrc_matches(mocker):
+    track_cache = TrackMatchCache()
+    track_cache.insert_isrc(("ISRC1", 1))
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+    mocker.patch("spotify_to_tidal.sync.failure_cache")
+    tidal_search = mocker.patch("spotify_to_tidal.sync.tidal_search", new_callable=mock.AsyncMock)
+    spotify_tracks = [make_spotify_track("spotify_1", "Song", ["Artist"], 200000, isrc="ISRC1")]
+
+    asyncio.run(search_new_tracks_on_tidal(mock.Mock(), spotify_tracks, "Playlist", {}))
+
+    assert track_cache.get("spotify_1") == 1
+    tidal_search.assert_not_called()
+
+
+def test_search_new_tracks_on_tidal_searches_once_per_isrc(mocker):
+    track_cache = TrackMatchCache()
+    mocker.patch("spotify_to_tidal.sync.track_match_cache", track_cache)
+    mocker.patch("spotify_to_tidal.sync.failure_cache")
+    tidal_search = mocker.patch("spotify_to_tidal.sync.tidal_search", new_callable=mock.AsyncMock)
+    tidal_search.return_value = make_tidal_track(1, "Song", ["Artist"], 200, isrc="ISRC1")
+    spotify_tracks = [
+        make_spotify_track("spotify_1", "Song", ["Artist"], 200000, isrc="ISRC1"),
+        make_spotify_track("spotify_2", "Song", ["Artist"], 200000, isrc="ISRC1"),
+    ]
+
+    progress_bar = mocker.patch("spotify_to_tidal.sync.tqdm")
+
+    asyncio.run(search_new_tracks_on_tidal(mock.Mock(), spotify_tracks, "Playlist", {}))
+
+    tidal_search.assert_called_once()
+    assert track_cache.get("spotify_1") == 1
+    assert track_cache.get("spotify_2") == 1
+    # the progress bar counts tracks rather than searches
+    assert progress_bar.call_args.kwargs["total"] == 2
+    progress_bar.return_value.__enter__.return_value.update.assert_called_once_with(2)
+
+
+def test_repeat_on_request_error_honours_retry_after(mocker):
+    sleep = mocker.patch("spotify_to_tidal.sync.asyncio.sleep", new_callable=mock.AsyncMock)
+    mocker.patch("spotify_to_tidal.sync.random.uniform", return_value=0)
+    error = requests.exceptions.HTTPError(response=mock.Mock(headers={"Retry-After": "3"}, text=""))
+    function = mock.AsyncMock(side_effect=[error, "result"])
+
+    assert asyncio.run(repeat_on_request_error(function)) == "result"
+    sleep.assert_awaited_once_with(3.0)